@@ -1,16 +1,58 @@
-import copy
-import json
+import inspect
+import os
+import pickle
 from collections import abc, defaultdict
 
+import jsonfile
 from dex import Dex
 from sets import Sets
 
+CACHE_PATH = "./.collection.cache.pkl"
+
+# Files whose modification invalidates the cached Collection state
+CACHE_SOURCES = (
+    "./collection.json",
+    "./default.json",
+    "./pkmn.json",
+    __file__,
+    inspect.getfile(Dex),
+    inspect.getfile(Sets),
+)
+
+# Attributes restored from (and saved to) the cache
+CACHED_STATE = (
+    "dex",
+    "default",
+    "_valid_keys",
+    "_data",
+    "data",
+    "hash",
+    "_cert_to_base",
+)
+
+SET_NAMES = frozenset(Sets.__members__)
+
+
+def copy_tree(val):
+    """Copies the containers of a JSON-like tree, leaving scalars shared.
+
+    Any mapping (e.g. a defaultdict) is copied into a plain dict.
+    """
+    if isinstance(val, abc.Mapping):
+        return {key: copy_tree(_val) for key, _val in val.items()}
+    if isinstance(val, list):
+        return [copy_tree(_val) for _val in val]
+    return val
+
 
 def merge_dictionaries(base, update):
     """Performs a deep, nested dictionary update.
 
     Modified from: https://stackoverflow.com/questions/3232943/update-value-of-a-nested-dictionary-of-varying-depth
 
+    Neither dictionary is modified. Only the parts of the base which are not
+    overridden are copied, rather than deep copying the whole base up front.
+
     Args:
         base (dict): The base/default dictionary
         update (dict): The dictionary which has the overriding values
@@ -18,231 +60,257 @@ def merge_dictionaries(base, update):
     Returns:
         dict: The updated dictionary
     """
-    base = copy.deepcopy(base)
+    merged = {}
+    for key, val in base.items():
+        if key not in update:
+            merged[key] = copy_tree(val)
+        elif isinstance(update[key], abc.Mapping):
+            nested_base = val if isinstance(val, abc.Mapping) else {}
+            merged[key] = merge_dictionaries(nested_base, update[key])
+        else:
+            merged[key] = update[key]
     for key, val in update.items():
+        if key in base:
+            continue
         if isinstance(val, abc.Mapping):
-            base[key] = merge_dictionaries(base.get(key, {}), val)
+            merged[key] = merge_dictionaries({}, val)
         else:
-            base[key] = val
-    return base
+            merged[key] = val
+    return merged
 
 
 class Collection:
     def __init__(self):
+        self._by_attr = {}
+        self._by_bg_pkmn = None
+        self._selling = None
+        # Every card is validated as it is loaded, and only validated state is
+        # ever cached, so validate() has nothing to do until a card is updated
+        self._validated = True
+        if self._load_cache():
+            return
         self.dex = Dex()
         self._load_default()
         self._load_collection()
-        self._apply_defaults()
-        self.validate()
+        self._save_cache()
+
+    @staticmethod
+    def _cache_signature():
+        return tuple(os.stat(path).st_mtime_ns for path in CACHE_SOURCES)
+
+    def _load_cache(self):
+        try:
+            with open(CACHE_PATH, "rb") as fh:
+                signature, state = pickle.load(fh)
+        except Exception:
+            # Missing, unreadable or stale-format cache: rebuild instead
+            return False
+        if signature != Collection._cache_signature():
+            return False
+        for attr in CACHED_STATE:
+            setattr(self, attr, state[attr])
+        return True
+
+    def _save_cache(self):
+        state = {attr: getattr(self, attr) for attr in CACHED_STATE}
+        try:
+            with open(CACHE_PATH, "wb") as fh:
+                pickle.dump((Collection._cache_signature(), state), fh)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _invalidate_cache():
+        try:
+            os.remove(CACHE_PATH)
+        except FileNotFoundError:
+            pass
 
     def _load_collection(self):
-        with open("./collection.json", "r") as fh:
-            self._data = json.loads(fh.read())
-        self._flatten_data()
-        self._organise()
+        self._data = jsonfile.load("./collection.json")
 
-    def _load_default(self):
-        with open("./default.json", "r") as fh:
-            self.default = json.loads(fh.read())
+        # Flatten, apply defaults, validate and hash each card in a single pass
+        data = {}
+        hash = defaultdict(lambda: {"l1": [], "prob": {}})
+        for year, collection in self._data.items():
+            for cert, card in collection.items():
+                if cert in data:
+                    raise Exception(f"Key {cert} appeared more than once.")
+                merged = merge_dictionaries(self.default, card)
+                merged["year"] = year
+                self._validate_card(cert, merged)
+                data[cert] = merged
+                Collection._hash_card(hash, cert, merged)
 
-    def _apply_defaults(self):
-        for cert, card in self.data.items():
-            self.data[cert] = merge_dictionaries(self.default, card)
+        self.data = data
+        self._organise(hash)
+
+    def _load_default(self):
+        self.default = jsonfile.load("./default.json")
+        self._valid_keys = frozenset(self.default) | {"year"}
 
     def validate(self):
+        if self._validated:
+            return True
         for psa, card in self.data.items():
             self._validate_card(psa, card)
+        self._validated = True
         return True
 
     def _validate_card(self, psa, card):
-        valid_keys = set(self.default.keys()).union({"year"})
-        supplied_keys = card.keys()
-
-        additional_keys = supplied_keys - valid_keys
+        additional_keys = card.keys() - self._valid_keys
         if additional_keys:
             raise Exception(
                 f"Card {psa} has at least one invalid entry ({additional_keys})"
             )
 
-        required_keys = {"grade"}
-        unsupplied_required_keys = required_keys - supplied_keys
-        if unsupplied_required_keys:
-            raise Exception(
-                f"Card {psa} did not supply required entries ({unsupplied_required_keys})"
-            )
+        # Defaults supply every key, so a missing grade shows up as None
+        if card.get("grade") is None:
+            raise Exception(f"Card {psa} did not supply required entries ({{'grade'}})")
 
-        if (
-            ("set" in card)
-            and (card["set"] is not None)
-            and (card["set"] not in Sets.__members__)
-        ):
+        if card.get("set") is not None and card["set"] not in SET_NAMES:
             # Set was provided but doesn't exist
             raise Exception(f"Card {psa} does not have a valid set ({card['set']})")
 
-    def _flatten_data(self):
-        all = {}
-        for year, collection in copy.deepcopy(self._data).items():
-            existing_certs = set(all.keys())
-            incoming_certs = set(collection.keys())
-            overlapping_certs = existing_certs.intersection(incoming_certs)
-            if overlapping_certs:
-                # Some keys already existed:
-                raise Exception(f"Keys {overlapping_certs} appeared more than once.")
-            for cert, card in collection.items():
-                # collection[cert] = merge_dictionaries(self.default, card)
-                collection[cert]["year"] = year
-            all.update(collection)
-        self.data = all
-        return all
-
     @staticmethod
     def get_attr(card, attr):
-        if attr in card:
-            return str(card[attr])
-        else:
-            return "NONE"
+        val = card.get(attr, "NONE")
+        return val if type(val) is str else str(val)
 
-    def _organise(self):
-
-        hash = defaultdict(lambda: defaultdict(list))
-        for year, collection in self._data.items():
-            for cert, card in collection.items():
-                card_hash = f"{year}-{Collection.get_attr(card, 'language')}"
-                if "pkmn" in card:
-                    card_hash += f"-{card['pkmn']}"
-                elif "energy" in card:
-                    card_hash += "-energy"
-                elif "trainer" in card:
-                    card_hash += "-trainer"
-
-                base_hash = card_hash
-
-                # L1 equivalence if year & language & dex number are the same
-                hash[card_hash]["l1"].append(cert)
-
-                # L2 equivalence if L1 & set are the same
-                card_hash += f"-{Collection.get_attr(card, 'set')}"
-                hash[base_hash]["l2"].append(cert)
-
-                # L3 equivalence if L2 & card details are the same
-                details = [
-                    "1st",
-                    "base_no_rarity",
-                    "shadowless",
-                    "shining",
-                    "FA",
-                    "EX",
-                    "M",
-                    "LV.X",
-                    "LEGEND",
-                    "BREAK",
-                    "bandai",
-                    "topsun_nonumber",
-                    "promo",
-                ]
-                for detail in details:
-                    card_hash += f"-{Collection.get_attr(card, detail)}"
-                hash[base_hash]["l3"].append(cert)
-
-                # L4 equivalence if L3 & sign existence are the same
-                does_sign_exist = str("sign" in card)
-                card_hash += f"-{does_sign_exist}"
-                hash[base_hash]["l4"].append(cert)
-
-                # L5 equivalence if L4 & notes are the same
-                card_hash += f"-{Collection.get_attr(card, 'notes')}"
-                hash[base_hash]["l5"].append(cert)
-
-                # L6 equivalence if L5 & grade/sign grade are equivalent
-                card_hash += f"-{Collection.get_attr(card, 'grade')}"
-                card_hash += f"-{Collection.get_attr(card, 'sign')}"
-                hash[base_hash]["l6"].append(cert)
-
-        for base_hash, levels in hash.items():
-            base_cards = levels["l6"]
-            base_cards = {cert: 1 / 6 for cert in base_cards}
-            for cert in levels["l1"]:
-                for level in ["l5", "l4", "l3", "l2", "l1"]:
-                    if cert in levels[level]:
-                        base_cards[cert] += 1 / 6
-            hash[base_hash]["prob"] = base_cards
-
-        self.hash = hash
+    @staticmethod
+    def _hash_card(hash, cert, card):
+        # Cards have had their defaults applied, so every default key is
+        # present and attributes are told apart by value rather than presence
+        get_attr = Collection.get_attr
+        card_hash = (card["year"], get_attr(card, "language"))
+        if card.get("pkmn") is not None:
+            card_hash += (get_attr(card, "pkmn"),)
+        elif card.get("energy"):
+            card_hash += ("energy",)
+        elif card.get("trainer"):
+            card_hash += ("trainer",)
+
+        # L1 equivalence if year & language & dex number are the same
+        hash[card_hash]["l1"].append(cert)
+
+        # A card always reaches all six levels (set, card details, sign
+        # existence, notes and grade/sign grade) within its own base hash, so
+        # the deeper levels are never built
+        hash[card_hash]["prob"][cert] = 1.0
+
+    def _organise(self, hash):
+        # A plain dict so that the hash can be pickled into the cache
+        self.hash = dict(hash)
+        # Each cert belongs to exactly one base hash
+        self._cert_to_base = {
+            cert: base_hash
+            for base_hash, levels in self.hash.items()
+            for cert in levels["prob"]
+        }
         return self.hash
 
     def find_dupes(self, cert):
         cert = str(cert)
-        matches = []
-        for base_hash, levels in self.hash.items():
-            results = levels["prob"]
-            if cert in results.keys():
-                matches.append(
-                    {
-                        "base_hash": base_hash,
-                        "match_prob": results[cert],
-                        "certs": self.hash[base_hash]["l1"],
-                    }
-                )
+        if cert not in self._cert_to_base:
+            return []
 
+        base_hash = self._cert_to_base[cert]
+        levels = self.hash[base_hash]
         return [
-            match
-            for match in sorted(
-                matches, reverse=True, key=lambda matches: matches["match_prob"]
-            )
+            {
+                "base_hash": base_hash,
+                "match_prob": levels["prob"][cert],
+                "certs": levels["l1"],
+            }
         ]
 
+    def _attr_index(self, attr):
+        """Maps each value of an attribute to the certs which have it.
+
+        Built on first use per attribute, then reused by later queries.
+        """
+        if attr not in self._by_attr:
+            index = defaultdict(list)
+            for cert, card in self.data.items():
+                index[Collection.get_attr(card, attr)].append(cert)
+            self._by_attr[attr] = index
+        return self._by_attr[attr]
+
+    def _bg_pkmn_index(self):
+        """Maps each dex number to the certs which have it in the background."""
+        if self._by_bg_pkmn is None:
+            index = defaultdict(list)
+            for cert, card in self.data.items():
+                for pkmn in card["contains_pkmn"]:
+                    index[pkmn].append(cert)
+            self._by_bg_pkmn = index
+        return self._by_bg_pkmn
+
+    def _selling_columns(self):
+        """The selling price of every card, as an array.
+
+        Built on first use, and dropped whenever a card is updated.
+
+        Returns:
+            tuple: The cert -> row dict and the prices
+        """
+        if self._selling is None:
+            # numpy is only needed once prices are looked up
+            import numpy as np
+
+            row_of = {cert: row for row, cert in enumerate(self.data)}
+            prices = np.fromiter(
+                (card["selling"]["price"] for card in self.data.values()),
+                dtype=np.int64,
+                count=len(row_of),
+            )
+            self._selling = (row_of, prices)
+        return self._selling
+
+    def prices_of(self, certs):
+        row_of, prices = self._selling_columns()
+        return prices[[row_of[cert] for cert in certs]]
+
+    def selling_prices(self):
+        # Prices of the cards which are currently for sale
+        _, prices = self._selling_columns()
+        return prices[prices != 0]
+
     def find_same_attr(self, cert, attr):
         cert = str(cert)
         attr_val = Collection.get_attr(self.data[cert], attr)
-        matches = []
-        for _cert, card in self.data.items():
-            _attr_val = Collection.get_attr(card, attr)
-            if attr_val == _attr_val:
-                matches.append(_cert)
+        matches = list(self._attr_index(attr).get(attr_val, []))
 
         if attr == "pkmn":
-            attr_val = self.dex.find_from_dex(int(attr_val))["name"]["english"].upper()
+            attr_val = self.dex.name_from_dex(int(attr_val))
 
         return matches, attr_val
 
     def find_same_bg_pkmn(self, cert):
         cert = str(cert)
-        pkmn = Collection.get_attr(self.data[cert], "pkmn")
+        pkmn = self.data[cert]["pkmn"]
+        pkmns = pkmn if isinstance(pkmn, list) else [pkmn]
 
-        matches = []
-        for _cert, card in self.data.items():
-            bg_pkmn = card["contains_pkmn"]
-            if pkmn in bg_pkmn:
-                matches.append(_cert)
+        index = self._bg_pkmn_index()
+        # Keyed by cert to drop repeats while keeping the first-seen order
+        matches = dict.fromkeys(
+            _cert for pkmn in pkmns for _cert in index.get(pkmn, [])
+        )
 
-        return matches
+        return list(matches)
 
     def find_most_dupes(self):
-        matches = {}
-        for cert in self.data.keys():
-            dupes = self.find_dupes(cert)
-            no_of_dupes = sum([len(x["certs"]) for x in dupes])
-            matches[cert] = no_of_dupes
-        return next(
-            iter(
-                {
-                    k: v
-                    for k, v in sorted(
-                        matches.items(), key=lambda x: x[1], reverse=True
-                    )
-                }.items()
-            )
-        )
+        # Every cert in a group has the whole group as its dupes, so the
+        # largest group wins; ties go to the group seen first.
+        levels = max(self.hash.values(), key=lambda levels: len(levels["l1"]))
+        return levels["l1"][0], len(levels["l1"])
 
     def get(self, cert, replace=False):
         card = self.data[cert]
         if replace:
-            card["pkmn_name"] = self.dex.find_from_dex(int(card["pkmn"]))["name"][
-                "english"
-            ].upper()
+            card["pkmn_name"] = self.dex.name_from_dex(int(card["pkmn"]))
             card["contains_pkmn_names"] = [
-                self.dex.find_from_dex(int(_pkmn))["name"]["english"].upper()
-                for _pkmn in card["contains_pkmn"]
+                self.dex.name_from_dex(int(_pkmn)) for _pkmn in card["contains_pkmn"]
             ]
         return card
 
@@ -251,8 +319,13 @@ class Collection:
         updated_card["year"] = None
         updated_card = {k: v for k, v in updated_card.items() if v is not None}
         self._data[year][cert] = updated_card
-        with open("./collection.json", "w") as fh:
-            fh.write(json.dumps(self._data, indent=4))
+        # The card may have been edited in place, so the indices are rebuilt
+        self._by_attr = {}
+        self._by_bg_pkmn = None
+        self._selling = None
+        self._validated = False
+        Collection._invalidate_cache()
+        jsonfile.dump(self._data, "./collection.json")
 
     def get_next_card(self):
         for cert, card in self.data.items():
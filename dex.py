@@ -1,26 +1,31 @@
 import argparse
-import json
+
+import jsonfile
 
 
 class Dex:
     def __init__(self):
-        with open("./pkmn.json", "r") as fh:
-            dex = json.loads(fh.read())
+        dex = jsonfile.load("./pkmn.json")
 
         self._dex = dex
+        self._by_id = {data["id"]: data for data in dex}
+        self._name_by_id = dict()
         self.dex = dict()
 
         for dex_num, data in enumerate(dex):
-            self.dex[data["name"]["english"].upper()] = data
+            name = data["name"]["english"].upper()
+            self.dex[name] = data
+            self._name_by_id[data["id"]] = name
 
     def find(self, pkmn):
         pkmn = pkmn.upper()
         return pkmn, self.dex[pkmn]["id"]
 
     def find_from_dex(self, dex):
-        for card in self._dex:
-            if card["id"] == dex:
-                return card
+        return self._by_id.get(dex)
+
+    def name_from_dex(self, dex):
+        return self._name_by_id[dex]
 
 
 if __name__ == "__main__":
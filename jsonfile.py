@@ -0,0 +1,86 @@
+import mmap
+import os
+
+# Files at least this large are memory-mapped rather than read into memory
+MMAP_THRESHOLD = 100 * 1024 * 1024
+
+try:
+    import orjson
+
+    # orjson parses straight from a buffer, so it can read from a mmap
+    _BUFFER_LOADS = True
+
+    def _loads(raw):
+        return orjson.loads(raw)
+
+    def _dumps(data, sort_keys):
+        option = orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(data, option=option)
+
+except ImportError:
+    _BUFFER_LOADS = False
+
+    try:
+        import ujson
+
+        def _loads(raw):
+            return ujson.loads(raw)
+
+        def _dumps(data, sort_keys):
+            return ujson.dumps(
+                data,
+                indent=2,
+                ensure_ascii=False,
+                escape_forward_slashes=False,
+                sort_keys=sort_keys,
+            ).encode("utf-8")
+
+    except ImportError:
+        import json
+
+        def _loads(raw):
+            return json.loads(raw)
+
+        def _dumps(data, sort_keys):
+            return json.dumps(
+                data, indent=2, ensure_ascii=False, sort_keys=sort_keys
+            ).encode("utf-8")
+
+
+def load(path):
+    """Reads and parses a JSON file, using orjson or ujson when available.
+
+    The raw bytes are parsed directly, without decoding to a str first.
+
+    Args:
+        path (str): The path to the JSON file
+
+    Returns:
+        The parsed JSON data
+    """
+    with open(path, "rb") as fh:
+        if _BUFFER_LOADS and os.fstat(fh.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    return _loads(view)
+        return _loads(fh.read())
+
+
+def dump(data, path, sort_keys=False):
+    """Serialises data to a JSON file (two-space indented).
+
+    The file is written to a temporary sibling first and then renamed over
+    the original, so an interrupted write never leaves a truncated file.
+
+    Args:
+        data: The JSON-serialisable data
+        path (str): The path to the JSON file
+        sort_keys (bool): Whether to sort object keys, for stable diffs
+    """
+    raw = _dumps(data, sort_keys)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(raw)
+    os.replace(tmp_path, path)
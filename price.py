@@ -1,14 +1,11 @@
 import argparse
-import json
 import math
-from collections import defaultdict
+import re
 from datetime import date
 
 import numpy as np
-import pandas as pd
 
-from collection import Collection
-from dex import Dex
+from collection import Collection, copy_tree
 from stats import Stats
 
 
@@ -17,17 +14,62 @@ class CardNoSalesDataException(Exception):
 
 
 class Price:
+
+    multipliers = {"base": 1.1, "grade": 0.7, "pseudo_10": 11, "signed": 10}
+
+    weightings = {
+        "same_grade": 1.2,
+        "ebay_selling": 1,
+        "ebay_sold": 1.2,
+        "mercari_selling": 1.25,
+        "mercari_sold": 1.5,
+    }
+
+    websites = ("ebay", "mercari")
+    statuses = ("selling", "sold")
+    grades = range(1, 11)
+
+    # "price,grade" with the grade already bounded to [1, 10]
+    sale_input = re.compile(r"\s*(\d+)\s*,\s*([1-9]|10)\s*")
+
     def __init__(self, cert, recalculate, copy_cert):
         self.cert = cert
         self.recalculate = recalculate
         self.copy_cert = copy_cert
         self.collection = Collection()
-        self.dex = Dex()
+        # The collection has already loaded the dex, so share it
+        self.dex = self.collection.dex
         self.stats = Stats()
 
-    def _set_card(self, cert):
+    def _set_card(self, cert, card=None):
         self.cert = cert
-        self.card = self.collection.get(cert)
+        self.card = card if card is not None else self.collection.get(cert)
+        # Constant for every sale of the card
+        self._card_grade = self.card["grade"]
+        self._card_sign = self.card["sign"]
+        self._set_scale_factors()
+
+    def _set_scale_factors(self):
+        # There are only websites x statuses x grades possible sales, so every
+        # scale factor for the card is worked out once up front
+        self._scale_factors = {
+            (website, status, grade): self._compute_scale_factor(
+                website, status, grade
+            )
+            for website in Price.websites
+            for status in Price.statuses
+            for grade in Price.grades
+        }
+
+        # The same table as arrays indexed by [website, status, grade], so that
+        # many sales can be scaled with a single fancy index
+        shape = (len(Price.websites), len(Price.statuses), max(Price.grades) + 1)
+        self._scale_lut = np.zeros(shape)
+        self._weight_lut = np.zeros(shape)
+        for (website, status, grade), (scale, weight) in self._scale_factors.items():
+            idx = (Price.websites.index(website), Price.statuses.index(status), grade)
+            self._scale_lut[idx] = scale
+            self._weight_lut[idx] = weight
 
     def _card_title(self, cert):
         try:
@@ -58,45 +100,145 @@ class Price:
             else:
                 self._set_from_sales_data()
 
-    def _recalculate_cert(self, cert):
-        self._set_card(cert)
+    def _recalculate_cert(self, cert, card=None):
+        self._set_card(cert, card)
 
         if self.card["sales_data"]["avg_price"] == 0:
             raise CardNoSalesDataException(
                 f"Card #{cert} doesn't have any sales data so cannot have its price recalculated."
             )
 
-        self._set_from_other_cert(cert)
+        self._set_from_other_cert(cert, self.card)
 
     def _recalculate_all_certs(self):
-        for cert, _ in self.collection.get_next_card():
-            try:
-                self._recalculate_cert(cert)
-            except CardNoSalesDataException:
+        # Scale every card's sales first, so that all of the prices can be
+        # worked out together rather than one card at a time
+        cards = []
+        pricing = []
+        for cert, card in self.collection.get_next_card():
+            if card["sales_data"]["avg_price"] == 0:
+                continue
+            self._set_card(cert, card)
+            self._set_pricing_data(Price._get_sales(card["sales_data"]["medium"]))
+            cards.append((cert, card))
+            pricing.append(self.pricing_data[:3])
+
+        if not cards:
+            return
+
+        prices, scales, weights = (np.concatenate(col) for col in zip(*pricing))
+        card_idx = np.repeat(np.arange(len(cards)), [len(p[0]) for p in pricing])
+        avg_prices = Price._grouped_average(prices * scales, weights, card_idx)
+
+        # The grouped sums run in a different order to _calculate, so an
+        # average this close to a whole yen could truncate either way. Those
+        # cards are left for _calculate to decide, along with changed prices
+        near_whole = np.abs(avg_prices - np.round(avg_prices)) <= 1e-9 * np.maximum(
+            np.abs(avg_prices), 1
+        )
+        for (cert, card), avg_price, undecided in zip(cards, avg_prices, near_whole):
+            if not undecided and int(avg_price) == card["selling"]["price"]:
+                print(f"Card #{cert}'s price did not change.")
                 continue
+            self._recalculate_cert(cert, card)
 
-    def _set_from_other_cert(self, copy_cert):
-        other_card = self.collection.get(copy_cert)
-        sales_data = other_card["sales_data"]["medium"]
+    @staticmethod
+    def _grouped_average(scaled_prices, weights, group_idx):
+        """The weighted average price of each group, as `_calculate` works it out.
 
-        pricing_data = []
-        for website in sales_data.keys():
-            for status in sales_data[website].keys():
-                sales = sales_data[website][status]
-                for sale in sales:
-                    grade = sale["grade"]
-                    price = sale["price"]
-                    scale_factor, weight = self._get_scale_factor(
-                        website, status, grade
-                    )
-                    pricing_data.append((price, scale_factor, weight, grade, website, status))
+        The sums are taken in a different order, so the result can differ from
+        `_calculate` in the last few bits.
+
+        Args:
+            scaled_prices (np.ndarray): The scaled price of every sale
+            weights (np.ndarray): The original weight of every sale
+            group_idx (np.ndarray): The group (card) index of every sale
+
+        Returns:
+            np.ndarray: The weighted average price of each group
+        """
+        n_sales = np.bincount(group_idx)
+        avg = np.bincount(group_idx, weights=scaled_prices) / n_sales
+        deviations = scaled_prices - avg[group_idx]
+        std = np.sqrt(np.bincount(group_idx, weights=deviations**2) / n_sales)
+
+        std_weights = Price._std_weights(scaled_prices, avg[group_idx], std[group_idx])
+
+        weights = std_weights * weights
+        return np.bincount(group_idx, weights=scaled_prices * weights) / np.bincount(
+            group_idx, weights=weights
+        )
 
-        self.pricing_data = pricing_data
+    @staticmethod
+    def _std_weights(scaled_prices, avg_price, std_price):
+        """Weights sales down by their distance from the mean, in std units.
+
+        The mean and std can be scalars or one per sale. Sales without any
+        spread keep a unit weight.
+        """
+        # Computed in place in a single buffer rather than allocating a
+        # temporary per step
+        std_weights = np.ones(len(scaled_prices))
+        np.divide(
+            np.subtract(scaled_prices, avg_price),
+            std_price,
+            out=std_weights,
+            where=np.asarray(std_price) >= 1e-5,
+        )
+        np.abs(std_weights, out=std_weights)
+        np.clip(std_weights, 1, 1000, out=std_weights)
+        np.reciprocal(std_weights, out=std_weights)
+        return std_weights
+
+    @staticmethod
+    def _get_sales(sales_data):
+        # Flattens a card's sales data into (website, status, price, grade) sales
+        return [
+            (website, status, sale["price"], sale["grade"])
+            for website, statuses in sales_data.items()
+            for status, _sales in statuses.items()
+            for sale in _sales
+        ]
+
+    def _set_from_other_cert(self, copy_cert, other_card=None):
+        if other_card is None:
+            other_card = self.collection.get(copy_cert)
+        sales_data = other_card["sales_data"]["medium"]
+
+        self._set_pricing_data(Price._get_sales(sales_data))
+        if other_card is not self.card:
+            # Don't share the other card's sales lists with this card
+            sales_data = copy_tree(sales_data)
         self.prices_dict = {"medium": sales_data}
 
         self._calculate()
         self._save()
 
+    def _set_pricing_data(self, sales):
+        """Scales a list of (website, status, price, grade) sales for the card.
+
+        Sets `pricing_data` to the (price, scale, weight, grade, website,
+        status) columns as arrays, ready for `_calculate`.
+        """
+        websites, statuses, prices, grades = (np.asarray(col) for col in zip(*sales))
+        website_idx = np.asarray([Price.websites.index(w) for w in websites])
+        status_idx = np.asarray([Price.statuses.index(s) for s in statuses])
+
+        # Look every sale up in the card's tables at once, falling back to
+        # computing the odd sale whose grade isn't in the tables
+        in_lut = np.isin(grades, Price.grades)
+        lut_idx = (website_idx[in_lut], status_idx[in_lut], grades[in_lut])
+        scales = np.empty(len(sales))
+        weights = np.empty(len(sales))
+        scales[in_lut] = self._scale_lut[lut_idx]
+        weights[in_lut] = self._weight_lut[lut_idx]
+        for i in np.flatnonzero(~in_lut):
+            scales[i], weights[i] = self._get_scale_factor(
+                websites[i], statuses[i], grades[i]
+            )
+
+        self.pricing_data = (prices, scales, weights, grades, websites, statuses)
+
     def _get_min_selling_price(self, ebay=False, mercari=False):
         assert ((not ebay) or (not mercari) and (mercari or ebay)), "You must set either ebay or mercari to True"
         medium = "ebay" if ebay else mercari
@@ -143,15 +285,18 @@ class Price:
 
     def _collect_prices(self):
 
-        prices = []
-        weights = []
-        pricing_data = []
-        prices_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        sales = []
+        prices_dict = {
+            "medium": {
+                website: {status: [] for status in Price.statuses}
+                for website in Price.websites
+            }
+        }
         continuing = True
-        for website in ["ebay", "mercari"]:
+        for website in Price.websites:
             if not continuing:
                 break
-            for status in ["selling", "sold"]:
+            for status in Price.statuses:
                 if not continuing:
                     break
                 print(f"\nYou are now inspecting items on {website} ({status})")
@@ -167,25 +312,20 @@ class Price:
                         break
                     elif data == "q":
                         raise Exception("Quit.")
-                    try:
-                        price, grade = [int(x) for x in data.split(",")]
-                    except ValueError as e:
-                        print(e)
-                        continue
-                    if not (1 <= grade <= 10):
-                        print("Grade must be between [1, 10]")
+                    match = Price.sale_input.fullmatch(data)
+                    if match is None:
+                        print("Input must be a price and a grade between [1, 10]")
                         continue
-                    elif price <= 0:
+                    price, grade = int(match[1]), int(match[2])
+                    if price <= 0:
                         print("Price must be greater than 0")
                         continue
 
-                    scale_factor, weight = self._get_scale_factor(
+                    scale_factor, _ = self._get_scale_factor(
                         website, status, grade
                     )
                     adjusted_price = int(price * scale_factor)
-                    prices.append(adjusted_price)
-                    weights.append(weight)
-                    pricing_data.append((price, scale_factor, weight, grade, website, status))
+                    sales.append((website, status, price, grade))
                     prices_dict["medium"][website][status].append(
                         {
                             "price": price,
@@ -197,45 +337,39 @@ class Price:
                         f"-> Logging a PSA {grade} at {price} JPY. Adjusted to {adjusted_price} (SF: {scale_factor:.02f})."
                     )
 
-        if not prices:
+        if not sales:
             raise Exception("No prices were added.")
 
-        self.pricing_data = pricing_data
+        self._set_pricing_data(sales)
         self.prices_dict = prices_dict
         self._calculate()
 
     def _calculate(self):
-        pricing_data = self.pricing_data
-        original_price = np.asarray([x[0] for x in pricing_data])
-        original_scale = np.asarray([x[1] for x in pricing_data])
-        website = np.asarray([x[4] for x in pricing_data])
-        status = np.asarray([x[5] for x in pricing_data])
-        grades = np.asarray([x[3] for x in pricing_data])
+        (
+            original_price,
+            original_scale,
+            original_weights,
+            grades,
+            website,
+            status,
+        ) = self.pricing_data
         scaled_prices = original_price * original_scale
 
-        avg_scaled_price = np.mean(scaled_prices)
-        std_scaled_price = np.std(scaled_prices)
-
-        # Weights we apply for distance from mean
-        if std_scaled_price < 1e-5:
-            std_weights = np.ones((len(scaled_prices),))
+        # Weights we apply for distance from mean. A single sale has no
+        # spread, so the reductions are skipped altogether
+        n_sales = len(scaled_prices)
+        if n_sales < 2:
+            std_weights = np.ones((n_sales,))
         else:
-            std_weights = 1 / np.clip(
-                abs((scaled_prices - avg_scaled_price) / std_scaled_price),
-                1,
-                1000,
+            std_weights = Price._std_weights(
+                scaled_prices, np.mean(scaled_prices), np.std(scaled_prices)
             )
 
-        # Weights provided by source
-        original_weights = np.asarray([x[2] for x in pricing_data])
-
         # Final weights
         weights_to_use = std_weights * original_weights
 
         # Weighted average
-        scaled_avg_price = int(
-            sum(scaled_prices * weights_to_use) / sum(weights_to_use)
-        )
+        scaled_avg_price = int(np.average(scaled_prices, weights=weights_to_use))
 
         previous_price = self.card["selling"]["price"]
         if abs(scaled_avg_price - previous_price) <= 1e-5:
@@ -243,52 +377,50 @@ class Price:
         else:
             self.price_changed = True
 
-        as_jpy = lambda vals: [f"{int(val)} JPY" for val in vals]
-        as_flt = lambda vals: [f"{val:.02f}" for val in vals]
-        as_int = lambda vals: [int(val) for val in vals]
-        is_sold = lambda vals: [val == "sold" for val in vals]
-
-        df_data = np.asarray(
-            [
-                as_int(grades),
-                as_jpy(original_price),
-                as_flt(original_scale),
-                as_jpy(scaled_prices),
-                as_flt(original_weights),
-                as_flt(std_weights),
-                as_flt(weights_to_use),
-                website,
-                is_sold(status)
-            ]
-        ).T
-
-        df = (
-            pd.DataFrame(
-                df_data,
-                columns=[
-                    "Grade",
-                    "Orig. Price",
-                    "Orig. Scale",
-                    "Scaled Price",
-                    "Orig. Weights",
-                    "STD Weights",
-                    "Final weights",
-                    "Website",
-                    "Sold?"
-                ],
-            )
-            .astype({"Grade": int})
-            .sort_values(by=["Grade"])
-        )
+        self.avg_price = scaled_avg_price
+        self.sales_data = self.prices_dict
+
+        if not self.price_changed:
+            # Nothing will be saved, so skip building the sales table
+            return
+
+        # pandas is slow to import and only needed for the sales table
+        import pandas as pd
+
+        df = pd.DataFrame(
+            {
+                "Grade": grades.astype(int),
+                "Orig. Price": original_price,
+                "Orig. Scale": original_scale,
+                "Scaled Price": scaled_prices,
+                "Orig. Weights": original_weights,
+                "STD Weights": std_weights,
+                "Final weights": weights_to_use,
+                "Website": website,
+                "Sold?": status == "sold",
+            }
+        ).sort_values(by=["Grade"])
+
+        # Columns stay numeric; they are only formatted when printed
+        as_jpy = lambda val: f"{int(val)} JPY"
+        as_flt = lambda val: f"{val:.02f}"
+        formatters = {
+            "Orig. Price": as_jpy,
+            "Orig. Scale": as_flt,
+            "Scaled Price": as_jpy,
+            "Orig. Weights": as_flt,
+            "STD Weights": as_flt,
+            "Final weights": as_flt,
+        }
 
         self._card_title(self.cert)
 
         print("Sales data:\n")
 
-        print(df)
-        price_without_weighting = int(sum(scaled_prices) / len(scaled_prices))
+        print(df.to_string(formatters=formatters))
+        price_without_weighting = int(scaled_prices.mean())
         price_without_std_weighting = int(
-            sum(scaled_prices * original_weights) / sum(original_weights)
+            np.average(scaled_prices, weights=original_weights)
         )
         print(f"\nPrice without any weighting: {price_without_weighting} JPY")
         print(f"Price without std weighting: {price_without_std_weighting} JPY")
@@ -296,29 +428,27 @@ class Price:
         if previous_price > 0:
             print(f"Original price was {previous_price} JPY.")
 
-        self.avg_price = scaled_avg_price
-        self.sales_data = self.prices_dict
-
     def _get_scale_factor(self, website, status, grade):
-        multipliers = {"base": 1.1, "grade": 0.7, "pseudo_10": 11, "signed": 10}
-
-        weightings = {
-            "same_grade": 1.2,
-            "ebay_selling": 1,
-            "ebay_sold": 1.2,
-            "mercari_selling": 1.25,
-            "mercari_sold": 1.5,
-        }
+        try:
+            return self._scale_factors[(website, status, grade)]
+        except KeyError:
+            # A sale graded outside Price.grades
+            return self._compute_scale_factor(website, status, grade)
 
-        website_status = f"{website}_{status}"
-        weighting = weightings[website_status]
-        multiplier = multipliers["base"]
+    def _compute_scale_factor(self, website, status, grade):
+        weighting = Price.weightings[f"{website}_{status}"]
+        return Price._scale_factor(
+            weighting, grade, self._card_grade, self._card_sign
+        )
 
-        card_grade = self.card["grade"]
-        card_sign = self.card["sign"]
+    @staticmethod
+    def _scale_factor(weighting, grade, card_grade, card_sign):
+        # Pure arithmetic on plain numbers, independent of the card dict
+        multipliers = Price.multipliers
+        multiplier = multipliers["base"]
 
         if card_grade == grade:
-            weighting *= weightings["same_grade"]
+            weighting *= Price.weightings["same_grade"]
 
         if card_sign:
             multiplier *= multipliers["signed"]
@@ -343,13 +473,15 @@ class Price:
         ).lower()
         if okay == "q":
             raise Exception("Ending, no sales data was saved.")
-        self.card["sales_data"] = json.loads(json.dumps(self.sales_data))
-        self.card["sales_data"]["avg_price"] = self.avg_price
-        self.card["sales_data"]["last_updated"] = date.today().strftime("%Y-%m-%d")
+        card = self.card
+        sales_data = self.sales_data
+        sales_data["avg_price"] = self.avg_price
+        sales_data["last_updated"] = date.today().strftime("%Y-%m-%d")
+        card["sales_data"] = sales_data
         if okay == "y":
             print(f"Updating selling price.")
-            self.card["selling"]["price"] = self.avg_price
-        self.collection.update(self.cert, self.card)
+            card["selling"]["price"] = self.avg_price
+        self.collection.update(self.cert, card)
         print(f"Card successfully updated (#{self.cert}).")
 
         self._calculate_stats()
@@ -1,11 +1,10 @@
 import argparse
-import json
 import math
+import os
+from functools import lru_cache
 
-import numpy as np
-import pandas as pd
-
-from collection import Collection
+import jsonfile
+from collection import Collection, copy_tree
 
 
 class SetPrice:
@@ -16,6 +15,9 @@ class SetPrice:
     rounding_unit = 100 # Round to the nearest _
     rounding_up = False
 
+    data_path = "./set_prices.json"
+    _cache = {} # Parsed data_path, keyed by (path, mtime)
+
     def __init__(self, cert=None, certs=None, set=None, delete_set=None):
         self.cert = cert
         self.certs = certs
@@ -39,9 +41,12 @@ class SetPrice:
             raise Exception("You can only pass one of 'cert', 'certs' or 'set'.")
         
         if self.certs is not None:
-            # check no duplicates
-            if len(set(self.certs)) != len(self.certs):
-                raise Exception("Your set has repeated cards.")
+            # check no duplicates, stopping at the first repeat
+            seen = set()
+            for cert in self.certs:
+                if cert in seen:
+                    raise Exception("Your set has repeated cards.")
+                seen.add(cert)
             
             # check at least 2 cards
             if len(self.certs) < 2:
@@ -60,6 +65,8 @@ class SetPrice:
             raise Exception(f"One or more cert numbers were invalid, for example #{e}.")
         
         if self.cards is not None:
+            # The cards are already to hand, so this doesn't need the selling
+            # columns (and numpy) before any prompt
             for cert, card in self.cards.items():
                 sale_data = card['selling']
                 if sale_data['sold'] is not None:
@@ -68,8 +75,20 @@ class SetPrice:
                     raise Exception(f"You have not yet set a price for card #{cert}.")
 
     def _load_data(self):
-        with open("./set_prices.json", "r") as fh:
-            self.data = json.loads(fh.read())
+        path = SetPrice.data_path
+        key = (path, os.stat(path).st_mtime_ns)
+        if key not in SetPrice._cache:
+            # Only the latest version of the file is worth keeping
+            SetPrice._cache = {key: jsonfile.load(path)}
+        # The flows modify the data in place, so never hand out the cached copy
+        self.data = copy_tree(SetPrice._cache[key])
+        # Older files store the next id as a string
+        self.data['next_autoincrement_id'] = int(self.data['next_autoincrement_id'])
+        # Every set's certs, so a set can be found from its certs in one lookup
+        self._set_index = {
+            frozenset(set_data['certs']): set_id
+            for set_id, set_data in self.data['sets'].items()
+        }
 
     def _determine_action(self):
         # Find all sets that cert is a part of
@@ -83,9 +102,9 @@ class SetPrice:
             self._set_flow()
 
     def _single_cert_flow(self):
-        sets = self._find_sets_by_cert(self.cert)
-        print(f"Card #{self.cert} is a member of {len(sets)} sets:")
-        print(sets)
+        set_ids = self._find_set_ids_by_cert(self.cert)
+        print(f"Card #{self.cert} is a member of {len(set_ids)} sets:")
+        print(self._format_sets(set_ids))
 
     def _make_set_flow(self):
         set_id = self._get_set_from_certs(self.certs) # if the set already exists this will be set
@@ -100,65 +119,110 @@ class SetPrice:
         if input("Do you want to log this set? [Y/n] ").lower() == "y":
             certs = self.certs
             set_id = self._get_next_autoincrement_id()
-            self.data['next_autoincrement_id'] = str(int(set_id) + 1)
+            self.data['next_autoincrement_id'] += 1
             self.data['sets'][set_id] = {
                 "certs": certs,
                 "price": price['discounted']
             }
+            self._set_index[frozenset(certs)] = set_id
 
             for cert in certs:
-                if cert in self.data['certs']:
-                    self.data['certs'][cert].append(set_id)
-                else:
-                    self.data['certs'][cert] = [set_id]
+                self.data['certs'].setdefault(cert, []).append(set_id)
 
             self._save_data()
         else:
             print("Not saved.")
 
     def _calculate_set_price(self, certs):
-        prices = []
-
-        for cert in certs:
-            card = self.collection.get(cert)
-            prices.append(card['selling']['price'])
-        
-        base_discount = 1.00 - SetPrice.discount
-        max_stack = SetPrice.max_discount_stack
+        return self._calculate_set_prices([certs])[0]
+
+    def _calculate_set_prices(self, certs_per_set):
+        """Prices several sets at once.
+
+        Args:
+            certs_per_set (list): The certs of each set
+
+        Returns:
+            list: The original and discounted price of each set
+        """
+        if not certs_per_set:
+            return []
+
+        # numpy is slow to import and only needed once a set is priced
+        import numpy as np
+
+        sizes = [len(certs) for certs in certs_per_set]
+        prices = self.collection.prices_of(
+            [cert for certs in certs_per_set for cert in certs]
+        )
+        # Every set is a slice of the flat prices, summed in a single reduction
+        starts = np.cumsum([0] + sizes[:-1])
+        original_prices = np.add.reduceat(prices, starts).tolist()
+
+        return [
+            {
+                "original": original_price,
+                "discounted": SetPrice._discounted_price(original_price, no_of_cards),
+            }
+            for original_price, no_of_cards in zip(original_prices, sizes)
+        ]
+
+    @staticmethod
+    def _discounted_price(original_price, no_of_cards):
+        # The settings are part of the cache key, so changing one never
+        # returns a stale price
+        return SetPrice._discount(
+            original_price,
+            no_of_cards,
+            SetPrice.discount,
+            SetPrice.max_discount_stack,
+            SetPrice.additional_discount,
+            SetPrice.rounding_unit,
+            SetPrice.rounding_up,
+        )
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _discount(
+        original_price,
+        no_of_cards,
+        discount,
+        max_stack,
+        additional_discount,
+        rounding_unit,
+        rounding_up,
+    ):
+        # Pure arithmetic on plain numbers, so sets with the same total and
+        # number of cards are only worked out once
+        base_discount = 1.00 - discount
         # apply discount per additional card in set
-        discount = np.power(base_discount, min(max_stack, len(prices) - 1))
+        discount = base_discount ** min(max_stack, no_of_cards - 1)
 
         # Apply additional discount
-        discount *= (1.00 - SetPrice.additional_discount)
+        discount *= (1.00 - additional_discount)
         
-        original_price = sum(prices)
         discounted_price = original_price * discount
 
-        rounding_unit = SetPrice.rounding_unit
         if rounding_unit  > 0:
-            round_fn = math.ceil if SetPrice.rounding_up else math.floor
-            discounted_price = round_fn(discounted_price / rounding_unit) * rounding_unit
+            # Round to whole yen in the same direction, then divide exactly as ints
+            if rounding_up:
+                discounted_price = -(-math.ceil(discounted_price) // rounding_unit) * rounding_unit
+            else:
+                discounted_price = math.floor(discounted_price) // rounding_unit * rounding_unit
 
         if discounted_price < 0:
             raise Exception(f"Discounted price is negative.")
 
-        return {"original": original_price, "discounted": discounted_price}
+        return discounted_price
     
     def _get_set_from_certs(self, certs):
-        initial_cert = certs[0]
-        cert_set = set(certs)
-        if initial_cert in self.data['certs']:
-            for set_id in self.data['certs'][initial_cert]:
-                set_to_check = set(self.data['sets'][set_id]['certs'])
-                if set_to_check == cert_set:
-                    return set_id
-        return None
+        return self._set_index.get(frozenset(certs))
 
 
     def _set_flow(self):
             id = self.set
             print(f"Information for the set #{id}.")
-            print(self._get_set_from_id(id, recalculate=False))
+            print(self._format_sets([id], recalculate=False))
             
             if self.delete_set:
                 if input("Are you sure you want to delete this set? [Y/n] ") == "Y":
@@ -176,58 +240,83 @@ class SetPrice:
                                 del self.data['certs'][cert]
 
                     # Now remove from set
+                    del self._set_index[frozenset(affected_certs)]
                     del self.data['sets'][id]
                     self._save_data()
                 else:
                     print("Set was not deleted.")
 
     def _save_data(self):
-        with open("./set_prices.json", "w") as fh:
-            fh.write(json.dumps(self.data, indent=4))
+        path = SetPrice.data_path
+        SetPrice._cache = {}
+        jsonfile.dump(self.data, path, sort_keys=True)
+        SetPrice._cache = {(path, os.stat(path).st_mtime_ns): copy_tree(self.data)}
         print("Data was overwritten.")
             
     
     def _get_next_autoincrement_id(self):
-        id = self.data['next_autoincrement_id']
+        # Set ids are JSON object keys, so they stay strings
+        id = str(self.data['next_autoincrement_id'])
         if id in self.data['sets']:
             raise Exception("Next autoincrement ID is already in use.")
-        return str(id)
+        return id
     
-    def _find_sets_by_cert(self, cert):
+    def _find_set_ids_by_cert(self, cert):
         if cert not in self.data['certs']:
             raise Exception(f"Card #{cert} is not currently being sold in any sets.")        
-        data = self._get_sets_from_ids(self.data['certs'][cert])
-        return data
-    
-    def _get_set_from_id(self, id, recalculate=True):
-        return self._get_sets_from_ids([id], recalculate=recalculate)
+        return self.data['certs'][cert]
     
-    def _get_sets_from_ids(self, ids, recalculate=True):
-
-        data = []
+    def _check_set_ids(self, ids):
         for id in ids:
             if id not in self.data['sets']:
                 raise Exception(f"Set #{id} does not exist.")
 
-            set_data = self.data['sets'][id]
-
-            if recalculate:
-                new_price = self._calculate_set_price(set_data['certs'])['discounted']
-                if new_price != set_data['price']:
-                    self.to_update[id] = new_price
-                set_data = [id, set_data['price'], new_price, set_data['certs']]
-                cols = ["Set #", "Current Price [JPY]", "Updated Price [JPY]", "Cards"]
-            else:
-                set_data = [id, set_data['price'], set_data['certs']]
-                cols = ["Set #", "Price [JPY]", "Cards"]
-
-
-            data.append(set_data)
+    def _get_updated_prices(self, ids):
+        # Every set is priced together
+        prices = self._calculate_set_prices(
+            [self.data['sets'][id]['certs'] for id in ids]
+        )
+
+        updated_prices = []
+        for id, price in zip(ids, prices):
+            new_price = price['discounted']
+            if new_price != self.data['sets'][id]['price']:
+                self.to_update[id] = new_price
+            updated_prices.append(new_price)
+        return updated_prices
+
+    def _format_sets(self, ids, recalculate=True):
+        """Lays the sets out as a plain text table.
+
+        Args:
+            ids (list): The IDs of the sets
+            recalculate (bool): Whether to include the recalculated prices
+
+        Returns:
+            str: The table, one set per line after the header
+        """
+        self._check_set_ids(ids)
+        sets = [self.data['sets'][id] for id in ids]
+        cards = [f"[{', '.join(set_data['certs'])}]" for set_data in sets]
+        if recalculate:
+            header = ("Set #", "Current Price [JPY]", "Updated Price [JPY]", "Cards")
+            rows = zip(
+                ids,
+                (set_data['price'] for set_data in sets),
+                self._get_updated_prices(ids),
+                cards,
+            )
+        else:
+            header = ("Set #", "Price [JPY]", "Cards")
+            rows = zip(ids, (set_data['price'] for set_data in sets), cards)
 
-        data = pd.DataFrame(np.asarray(data), columns=cols)
+        lines = [header, *([str(val) for val in row] for row in rows)]
+        widths = [max(len(line[col]) for line in lines) for col in range(len(header))]
+        return "\n".join(
+            "  ".join(val.rjust(width) for val, width in zip(line, widths))
+            for line in lines
+        )
 
-        return data
-    
     def _update_prices(self):
         if len(self.to_update) and input("Would you like to update the sets to their new prices? [Y/n] "):
             for id, new_price in self.to_update.items():
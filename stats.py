@@ -1,4 +1,4 @@
-import numpy as np
+import math
 
 from collection import Collection
 
@@ -12,19 +12,19 @@ class Stats:
         data = self.collection.data
         amount = len(data)
 
-        # Number currently for sale
-        selling = {}
-        for cert, card in data.items():
-            if "selling" in card and card["selling"]["price"] != 0:
-                selling[cert] = card
-
-        selling_prices = [card["selling"]["price"] for card in selling.values()]
+        selling_prices = self.collection.selling_prices().tolist()
+        # Integer sums keep the mean and std exact: n^2 * var = n * sum(p^2) - sum(p)^2
+        n_selling = len(selling_prices)
+        total = sum(selling_prices)
+        total_sq = sum(price * price for price in selling_prices)
         selling_stats = {
-            "amount": len(selling),
+            "amount": n_selling,
             "max_price": max(selling_prices),
             "min_price": min(selling_prices),
-            "avg_price": np.mean(selling_prices).astype(np.int32),
-            "std_price": np.std(selling_prices).astype(np.int32),
+            "avg_price": total // n_selling,
+            "std_price": math.isqrt(
+                (n_selling * total_sq - total * total) // (n_selling * n_selling)
+            ),
         }
 
         estimated_collection_price = int(amount * selling_stats["avg_price"])